@@ -1,11 +1,66 @@
+from __future__ import annotations
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import HTTPError as Urllib3Error
+from urllib3.util.retry import Retry
 import os
 import hashlib
+import sqlite3
 import logging
-from urllib.parse import urlparse
+import re
+import string
 from pathlib import Path
 import time
-from typing import List, Set, Dict, Optional
+import tempfile
+import threading
+from contextlib import nullcontext
+from functools import lru_cache
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+try:
+    from tqdm import tqdm
+    from tqdm.contrib.logging import logging_redirect_tqdm
+except ImportError:  # progress bar is optional
+    tqdm = None
+
+# scheme, host and path of an http(s) URL (any user:password@ prefix is skipped).
+# Backslashes are excluded from the authority: requests treats '\' as the end of the
+# host, so an authority containing one never matches and the URL is rejected.
+_URL_RE = re.compile(r'^(https?)://(?:[^/?#\\]*@)?([^/:?#@\\]+)(?::\d+)?(?=[/?#]|$)(/[^?#]*)?', re.IGNORECASE)
+# ASCII bytes not allowed in saved filenames
+_SAFE_CHARS = string.ascii_letters + string.digits + '._-'
+_UNSAFE_BYTES = bytes(i for i in range(256) if chr(i) not in _SAFE_CHARS)
+# file extension for each image MIME type, used when the URL has none
+_CT_TO_EXT = {
+    'image/png': '.png',
+    'image/x-png': '.png',
+    'image/gif': '.gif',
+    'image/webp': '.webp',
+    'image/bmp': '.bmp',
+    'image/x-bmp': '.bmp',
+    'image/x-ms-bmp': '.bmp',
+    'image/tiff': '.tiff',
+    'image/x-tiff': '.tiff',
+    'image/jpeg': '.jpg',
+    'image/jpg': '.jpg',
+    'image/pjpeg': '.jpg',
+}
+# URL path extensions that are never images, rejected before any request.
+# Script endpoints (.php, .asp, ...) are left out since they often serve images.
+_NON_IMAGE_EXTENSIONS = frozenset({
+    '.exe', '.msi', '.dll', '.bat', '.cmd', '.com', '.scr', '.ps1', '.sh', '.apk', '.dmg', '.deb', '.rpm', '.jar',
+    '.zip', '.rar', '.7z', '.tar', '.gz', '.tgz', '.bz2', '.xz', '.iso',
+    '.html', '.htm', '.xhtml', '.js', '.css', '.json', '.xml', '.txt', '.csv',
+    '.pdf', '.doc', '.docx', '.xls', '.xlsx', '.ppt', '.pptx',
+    '.mp3', '.wav', '.ogg', '.flac', '.mp4', '.mkv', '.avi', '.mov', '.webm',
+})
+
+@lru_cache(maxsize=4096)
+def _host_blocked(host: str, blocked_domains: frozenset[str]) -> bool:
+    """Whether host is a blocked domain or a subdomain of one (cached per host)"""
+    return host in blocked_domains or any(host.endswith('.' + d) for d in blocked_domains)
 
 # Configure logging
 logging.basicConfig(
@@ -18,47 +73,142 @@ logging.basicConfig(
 )
 
 class SecureImageDownloader:
+    DOWNLOAD_CHUNK = 128 * 1024  # bytes per body read
+    MAX_WORKERS = 8
+    HOST_DELAY = 0.5  # seconds between requests to the same host
+    HEAD_PRECHECK = False  # send a HEAD before each GET to reject bad URLs without a body
+    
     def __init__(self, download_dir: str = "Fetched_Images"):
         self.download_dir = Path(download_dir)
         self.download_dir.mkdir(exist_ok=True)
-        self.downloaded_hashes: Set[str] = set()
-        self.load_existing_hashes()
+        self._hash_lock = threading.Lock()
+        self._batch_depth = 0  # running batches; they commit hashes once at the end
+        self._last_hit: dict[str, float] = {}  # host -> monotonic time of last request slot
+        self._rate_lock = threading.Lock()
+        
+        # Shared session so connections are pooled and kept alive across downloads
+        self.session = requests.Session()
+        self.session.headers.update({
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+            'Accept': 'image/*,*/*;q=0.8',
+            'Accept-Language': 'en-US,en;q=0.5',
+            'Connection': 'keep-alive',
+            'Upgrade-Insecure-Requests': '1'
+        })
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16,
+                              max_retries=Retry(total=2, backoff_factor=0.3))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
         
         # Security settings
         self.max_file_size = 50 * 1024 * 1024  # 50MB limit
         self.allowed_extensions = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp', '.tiff'}
-        self.blocked_domains = {'malware.com', 'suspicious-site.org'}  # Add known bad domains
+        self.blocked_domains = frozenset(d.lower() for d in {'malware.com', 'suspicious-site.org'})  # Add known bad domains
+        
+        self.downloaded_hashes: set[bytes] = set()
+        self.load_existing_hashes()
         
     def load_existing_hashes(self):
         """Load hashes of already downloaded files to prevent duplicates"""
-        hash_file = self.download_dir / "file_hashes.txt"
-        if hash_file.exists():
-            with open(hash_file, 'r') as f:
-                self.downloaded_hashes = set(line.strip() for line in f if line.strip())
+        db_file = self.download_dir / "hashes.db"
+        new_db = not db_file.exists()
+        self.hash_db = sqlite3.connect(str(db_file), check_same_thread=False)
+        self.hash_db.execute("CREATE TABLE IF NOT EXISTS hashes (digest BLOB PRIMARY KEY)")
+        
+        # Migrate the old text manifest, if present
+        legacy_file = self.download_dir / "file_hashes.txt"
+        if legacy_file.exists():
+            with open(legacy_file, 'r') as f:
+                digests = [(bytes.fromhex(line.strip()),) for line in f if line.strip()]
+            with self.hash_db:
+                self.hash_db.executemany("INSERT OR IGNORE INTO hashes VALUES (?)", digests)
+            legacy_file.rename(legacy_file.with_suffix('.txt.migrated'))
+        elif new_db:
+            # No manifest at all: rebuild it from the images already on disk
+            # Saved names keep the URL's suffix (e.g. img_<hash>.php), so index every
+            # file except our own bookkeeping files
+            digests = [(self.hash_existing_file(p),) for p in self.download_dir.iterdir()
+                       if p.is_file() and not p.name.startswith(db_file.name)
+                       and p.suffix not in ('.part', '.migrated')]
+            if digests:
+                logging.info(f"Rebuilt hash index from {len(digests)} existing files")
+            with self.hash_db:
+                self.hash_db.executemany("INSERT OR IGNORE INTO hashes VALUES (?)", digests)
+        
+        self.downloaded_hashes = {row[0] for row in self.hash_db.execute("SELECT digest FROM hashes")}
+    
+    def hash_existing_file(self, path: Path) -> bytes:
+        """Calculate the SHA-256 digest of a file on disk"""
+        with open(path, 'rb') as f:
+            if hasattr(hashlib, 'file_digest'):  # Python 3.11+
+                return hashlib.file_digest(f, lambda: hashlib.sha256(usedforsecurity=False)).digest()
+            h = hashlib.sha256(usedforsecurity=False)
+            while chunk := f.read(self.DOWNLOAD_CHUNK):
+                h.update(chunk)
+            return h.digest()
+    
+    def save_file_hash(self, digest: bytes):
+        """Save file hash to prevent future duplicates (committed by commit_hashes)"""
+        self.hash_db.execute("INSERT OR IGNORE INTO hashes VALUES (?)", (digest,))
+        self.downloaded_hashes.add(digest)
+    
+    def commit_hashes(self):
+        """Commit pending hash inserts in a single transaction"""
+        with self._hash_lock:
+            self.hash_db.commit()
     
-    def save_file_hash(self, file_hash: str):
-        """Save file hash to prevent future duplicates"""
-        hash_file = self.download_dir / "file_hashes.txt"
-        with open(hash_file, 'a') as f:
-            f.write(f"{file_hash}\n")
-        self.downloaded_hashes.add(file_hash)
+    def close(self):
+        """Close the hash store and HTTP session"""
+        self.commit_hashes()
+        self.hash_db.close()
+        self.session.close()
     
-    def calculate_file_hash(self, content: bytes) -> str:
-        """Calculate SHA-256 hash of file content"""
-        return hashlib.sha256(content).hexdigest()
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+    
+    def __del__(self):
+        # Fallback for callers that never close(): don't lose pending hashes
+        try:
+            self.commit_hashes()
+        except Exception:
+            pass
+    
+    def _wait_for_host(self, host: str):
+        """Sleep only as long as needed to keep HOST_DELAY between requests to a host"""
+        with self._rate_lock:
+            now = time.monotonic()
+            slot = max(now, self._last_hit.get(host, 0.0) + self.HOST_DELAY)
+            self._last_hit[host] = slot
+        if slot > now:
+            time.sleep(slot - now)
     
     def validate_url(self, url: str) -> bool:
         """Validate URL for security concerns"""
         try:
-            parsed = urlparse(url)
+            m = _URL_RE.match(url)
+            if not m:
+                logging.warning(f"Unsupported URL: {url}")
+                return False
+            
+            # Check if domain (or any parent domain) is blocked; a trailing '.'
+            # (fully qualified form) resolves to the same host
+            host = m.group(2).lower().rstrip('.')
+            if _host_blocked(host, self.blocked_domains):
+                logging.warning(f"Blocked domain detected: {host}")
+                return False
             
-            # Check if domain is blocked
-            if parsed.netloc.lower() in self.blocked_domains:
-                logging.warning(f"Blocked domain detected: {parsed.netloc}")
+            # Reject known non-image links without touching the network. Anything
+            # else (no extension, .avif, /api/v2.1, ...) is left to the content-type check.
+            suffix = Path(m.group(3) or '').suffix.lower()
+            if suffix in _NON_IMAGE_EXTENSIONS:
+                logging.warning(f"Non-image file extension {suffix}: {url}")
                 return False
                 
             # Check if URL uses HTTPS (preferred for security)
-            if parsed.scheme != 'https':
+            if m.group(1).lower() != 'https':
                 logging.warning(f"Non-HTTPS URL detected: {url}")
                 # Don't block, but warn user
                 
@@ -67,20 +217,33 @@ class SecureImageDownloader:
             logging.error(f"URL validation error: {e}")
             return False
     
-    def validate_http_headers(self, response: requests.Response) -> bool:
-        """Validate HTTP headers before saving content"""
+    def check_type_and_size(self, response: requests.Response) -> str | None:
+        """Check content type and length; returns the content type, or None if rejected"""
         try:
             # Check content type
             content_type = response.headers.get('content-type', '').lower()
-            if not any(ext in content_type for ext in ['image/', 'application/octet-stream']):
+            if not ('image/' in content_type or 'application/octet-stream' in content_type):
                 logging.warning(f"Unexpected content type: {content_type}")
-                return False
+                return None
             
             # Check content length
             content_length = response.headers.get('content-length')
             if content_length and int(content_length) > self.max_file_size:
                 logging.error(f"File too large: {content_length} bytes")
-                return False
+                return None
+            
+            return content_type
+            
+        except Exception as e:
+            logging.error(f"Header validation error: {e}")
+            return None
+    
+    def validate_http_headers(self, response: requests.Response) -> str | None:
+        """Validate HTTP headers before saving content; returns the content type, or None if rejected"""
+        try:
+            content_type = self.check_type_and_size(response)
+            if content_type is None:
+                return None
             
             # Check for suspicious headers
             suspicious_headers = ['x-powered-by', 'server']
@@ -94,116 +257,134 @@ class SecureImageDownloader:
                 if header in response.headers:
                     logging.info(f"Security header present: {header}")
             
-            return True
+            return content_type
             
         except Exception as e:
             logging.error(f"Header validation error: {e}")
-            return False
+            return None
     
     def get_safe_filename(self, url: str, content_type: str) -> str:
         """Generate a safe filename from URL and content type"""
-        parsed_url = urlparse(url)
-        filename = os.path.basename(parsed_url.path)
+        m = _URL_RE.match(url)
+        path = (m.group(3) or '') if m else ''
         
-        if not filename or '.' not in filename:
-            # Determine extension from content type
-            ext = '.jpg'  # default
-            if 'png' in content_type:
-                ext = '.png'
-            elif 'gif' in content_type:
-                ext = '.gif'
-            elif 'webp' in content_type:
-                ext = '.webp'
-            elif 'bmp' in content_type:
-                ext = '.bmp'
-            elif 'tiff' in content_type:
-                ext = '.tiff'
+        # Sanitize at the byte level; only ASCII characters are kept anyway
+        name_bytes = os.path.basename(path).encode('ascii', 'ignore').translate(None, _UNSAFE_BYTES)
+        stem, _, ext = name_bytes.rpartition(b'.')
+        
+        if not stem.strip(b'.') or not ext:
+            # Determine extension from content type (default .jpg)
+            mime_type = content_type.split(';', 1)[0].strip().lower()
+            ext = _CT_TO_EXT.get(mime_type, '.jpg')
             
-            filename = f"downloaded_image_{int(time.time())}{ext}"
+            return f"downloaded_image_{int(time.time())}{ext}"
         
-        # Sanitize filename
-        filename = "".join(c for c in filename if c.isalnum() or c in "._-")
-        return filename
+        return name_bytes.decode('ascii')
     
-    def download_image(self, url: str) -> bool:
+    def download_image(self, url: str, validated: bool = False) -> bool:
         """Download a single image with security checks"""
         try:
-            # Validate URL
-            if not self.validate_url(url):
+            # Validate URL (batch runs validate before waiting on the host)
+            if not validated and not self.validate_url(url):
                 return False
             
             logging.info(f"Starting download: {url}")
             
-            # Create session with security headers
-            session = requests.Session()
-            session.headers.update({
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-                'Accept': 'image/*,*/*;q=0.8',
-                'Accept-Language': 'en-US,en;q=0.5',
-                'Accept-Encoding': 'gzip, deflate',
-                'Connection': 'keep-alive',
-                'Upgrade-Insecure-Requests': '1'
-            })
+            # Optionally check size and type with a HEAD request so bad URLs never
+            # send a body. The HEAD and GET share one host slot. Servers without
+            # HEAD support fall through to the streaming checks.
+            if self.HEAD_PRECHECK:
+                try:
+                    head = self.session.head(url, timeout=10, allow_redirects=True)
+                    if head.ok and self.check_type_and_size(head) is None:
+                        return False
+                except requests.exceptions.RequestException:
+                    pass
             
             # Download with streaming to check size
-            response = session.get(url, timeout=30, stream=True)
-            response.raise_for_status()
+            response = self.session.get(url, timeout=30, stream=True)
+            if response.status_code >= 400:
+                logging.error(f"HTTP {response.status_code} for {url}")
+                response.close()
+                return False
             
             # Validate headers
-            if not self.validate_http_headers(response):
+            content_type = self.validate_http_headers(response)
+            if content_type is None:
+                response.close()
                 return False
             
-            # Read content in chunks to check size
-            content = b''
-            for chunk in response.iter_content(chunk_size=8192):
-                content += chunk
-                if len(content) > self.max_file_size:
-                    logging.error(f"File too large during download: {len(content)} bytes")
-                    return False
-            
-            # Check for duplicates using hash
-            file_hash = self.calculate_file_hash(content)
-            if file_hash in self.downloaded_hashes:
-                logging.info(f"Duplicate file detected, skipping: {url}")
-                return False
+            content_length = int(response.headers.get('content-length') or 0)
+            if content_length:
+                logging.debug(f"Expected size: {content_length} bytes")
             
-            # Generate safe filename
-            content_type = response.headers.get('content-type', '')
-            filename = self.get_safe_filename(url, content_type)
-            filepath = self.download_dir / filename
+            # Stream content to a temp file, hashing and checking size as we go.
+            # Each call owns its hasher and hashlib releases the GIL on large
+            # chunks, so concurrent downloads hash in parallel.
+            # Dedup fingerprint only, so skip FIPS security bookkeeping
+            h = hashlib.sha256(usedforsecurity=False)
+            total = 0
+            with tempfile.NamedTemporaryFile(dir=self.download_dir, suffix=".part", delete=False) as tmp:
+                try:
+                    # Read urllib3's response directly, skipping iter_content's generator layer
+                    read = response.raw.read
+                    while True:
+                        chunk = read(self.DOWNLOAD_CHUNK, decode_content=True)
+                        if not chunk:
+                            break
+                        h.update(chunk)
+                        tmp.write(chunk)
+                        total += len(chunk)
+                        if total > self.max_file_size:
+                            logging.error(f"File too large during download: {total} bytes")
+                            break
+                except BaseException:
+                    tmp.close()
+                    os.unlink(tmp.name)
+                    raise
             
-            # Handle filename conflicts
-            counter = 1
-            original_filepath = filepath
-            while filepath.exists():
-                stem = original_filepath.stem
-                suffix = original_filepath.suffix
-                filepath = self.download_dir / f"{stem}_{counter}{suffix}"
-                counter += 1
+            if total > self.max_file_size:
+                response.close()
+                os.unlink(tmp.name)
+                return False
             
-            # Save file
-            with open(filepath, 'wb') as f:
-                f.write(content)
+            digest = h.digest()
             
-            # Save hash to prevent future duplicates
-            self.save_file_hash(file_hash)
+            # Dedup check and file placement must not interleave across threads
+            with self._hash_lock:
+                # Check for duplicates using hash
+                if digest in self.downloaded_hashes:
+                    logging.info(f"Duplicate file detected, skipping: {url}")
+                    os.unlink(tmp.name)
+                    return False
+                
+                # Generate safe filename
+                safe_name = Path(self.get_safe_filename(url, content_type))
+                
+                # Suffix with a digest prefix so distinct content never collides
+                filename = f"{safe_name.stem}_{digest.hex()[:12]}{safe_name.suffix}"
+                filepath = self.download_dir / filename
+                
+                # Move completed file into place
+                os.replace(tmp.name, filepath)
+                
+                # Save hash to prevent future duplicates
+                self.save_file_hash(digest)
+                if not self._batch_depth:
+                    self.hash_db.commit()
             
             logging.info(f"Successfully downloaded: {filename}")
-            print(f"✓ Successfully fetched: {filename}")
-            print(f"✓ Image saved to {filepath}")
             
             return True
             
-        except requests.exceptions.RequestException as e:
+        except (requests.exceptions.RequestException, Urllib3Error) as e:
             logging.error(f"Request error for {url}: {e}")
-            print(f"✗ Connection error for {url}: {e}")
             return False
         except Exception as e:
             logging.error(f"Unexpected error for {url}: {e}")
-            print(f"✗ An error occurred for {url}: {e}")
             return False
     
-    def download_multiple_images(self, urls: List[str]) -> Dict[str, bool]:
+    def download_multiple_images(self, urls: list[str]) -> dict[str, bool]:
         """Download multiple images with progress tracking"""
         results = {}
         total_urls = len(urls)
@@ -211,12 +392,52 @@ class SecureImageDownloader:
         print(f"\nStarting batch download of {total_urls} images...")
         print("=" * 50)
         
-        for i, url in enumerate(urls, 1):
-            print(f"\n[{i}/{total_urls}] Processing: {url}")
-            results[url] = self.download_image(url)
-            
-            # Add small delay to be respectful to servers
-            time.sleep(0.5)
+        # Group by host so the politeness delay only applies to same-host requests
+        by_host = defaultdict(list)
+        for url in urls:
+            m = _URL_RE.match(url)
+            by_host[m.group(2).lower().rstrip('.') if m else ''].append(url)
+        
+        progress = tqdm(total=total_urls, unit='img') if tqdm else None
+        
+        def fetch_host(host: str, host_urls: list[str]) -> dict[str, bool]:
+            host_results = {}
+            for url in host_urls:
+                # Rejected URLs cost no network I/O, so they don't wait for a host slot
+                if self.validate_url(url):
+                    self._wait_for_host(host)
+                    host_results[url] = self.download_image(url, validated=True)
+                else:
+                    host_results[url] = False
+                if progress is not None:
+                    progress.update(1)
+            return host_results
+        
+        with self._hash_lock:
+            self._batch_depth += 1
+        try:
+            # Route console logging through tqdm so the bar stays on one line
+            with logging_redirect_tqdm() if progress is not None else nullcontext():
+                # Strings that don't parse as http(s) URLs have no host to wait on
+                for url in by_host.pop('', []):
+                    logging.warning(f"Unsupported URL: {url}")
+                    results[url] = False
+                    if progress is not None:
+                        progress.update(1)
+                
+                with ThreadPoolExecutor(max_workers=self.MAX_WORKERS) as executor:
+                    futures = [executor.submit(fetch_host, host, host_urls)
+                               for host, host_urls in by_host.items()]
+                    for future in as_completed(futures):
+                        results.update(future.result())
+        finally:
+            if progress is not None:
+                progress.close()
+            with self._hash_lock:
+                self._batch_depth -= 1
+            self.commit_hashes()
+        
+        results = {url: results[url] for url in urls}
         
         # Summary
         successful = sum(results.values())
@@ -231,7 +452,7 @@ class SecureImageDownloader:
         
         return results
 
-def get_urls_from_user() -> List[str]:
+def get_urls_from_user() -> list[str]:
     """Get multiple URLs from user input"""
     print("Enter image URLs (one per line). Press Enter on empty line when done:")
     urls = []
@@ -249,17 +470,16 @@ def main():
     print("A tool for mindfully collecting images from the web")
     print("Now with enhanced security and batch processing!\n")
     
-    downloader = SecureImageDownloader()
-    
-    # Get URLs from user
-    urls = get_urls_from_user()
-    
-    if not urls:
-        print("No URLs provided. Exiting.")
-        return
-    
-    # Download all images
-    downloader.download_multiple_images(urls)
+    with SecureImageDownloader() as downloader:
+        # Get URLs from user
+        urls = get_urls_from_user()
+        
+        if not urls:
+            print("No URLs provided. Exiting.")
+            return
+        
+        # Download all images
+        downloader.download_multiple_images(urls)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file